@@ -1,19 +1,40 @@
 import os
 import sys
+import hmac
 import json
+from functools import lru_cache
 
 from fastapi import Query, HTTPException, status
 from dotenv import load_dotenv
 
 load_dotenv()
 SECRETS = os.getenv("SECRETS") and json.loads(os.getenv("SECRETS")).values()
+# secrets are encoded once at import, so every request
+# only pays for the constant-time comparison
+SECRETS_BYTES = [secret.encode() for secret in SECRETS or []]
 # added paths to the system path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-def verify_access(password: str = Query(..., description="The password for access")):
+# clients reuse the same password, so most checks are cache hits;
+# the size is bounded to survive brute force attempts
+@lru_cache(maxsize=1024)
+def check_password(password):
+    provided = password.encode()
+    # compare against every secret without breaking early
+    # so the response time doesn't depend on the input
+    ok = False
+    for secret in SECRETS_BYTES:
+        ok |= hmac.compare_digest(provided, secret)
+
+    return ok
+
+
+# async, so FastAPI runs it on the event loop instead of
+# sending every request through the threadpool just for auth
+async def verify_access(password: str = Query(..., description="The password for access")):
     """Simple authentication"""
 
-    if password not in SECRETS:
+    if not check_password(password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid password",
@@ -1,17 +1,57 @@
+import os
+import asyncio
+import logging
 import subprocess
-import json
+from contextlib import asynccontextmanager
+
+import orjson
 from fastapi import (FastAPI, status, 
-                     Depends, Request)
-from starlette.concurrency import iterate_in_threadpool
+                     Depends, Response)
+from fastapi.responses import ORJSONResponse
+from starlette.concurrency import run_in_threadpool
 import uvicorn
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from api.auth import verify_access
 from scheduler.scheduler import Scheduler
-from scheduler.celery_worker import unblock_proxy
+from scheduler.celery_worker import unblock_proxies
 from scheduler.unblock_all_proxies import unblocking_proxy_subprocess
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+# scheduler keeps the redis connection,
+# so it is created once per process
+scheduler = Scheduler()
+# proxies waiting to be sent to celery for unblocking,
+# bounded so requests slow down while the broker is unreachable
+UNBLOCK_QUEUE_SIZE = 10000
+UNBLOCK_BATCH_SIZE = 64
+UNBLOCK_BATCH_WAIT = 0.005
+UNBLOCK_RETRY_DELAY = 1
+UNBLOCK_RETRY_MAX_DELAY = 30
+UNBLOCK_SHUTDOWN_TIMEOUT = 10
+# caps the latency of one /get_proxies request,
+# empty sources are refilled one after another
+MAX_BATCH_SIZE = 100
+unblock_queue = asyncio.Queue(maxsize=UNBLOCK_QUEUE_SIZE)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    drainer = asyncio.create_task(drain_unblock_queue())
+    # build the schema now, so the first /docs
+    # request doesn't have to wait for it
+    app.openapi()
+    yield
+    # let the drainer send what is still queued
+    try:
+        await asyncio.wait_for(stop_drainer(drainer), UNBLOCK_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error("Unblock queue wasn't flushed on shutdown, %d queued proxies "
+                     "are left to the periodic unblocking", unblock_queue.qsize())
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 
 class Report(BaseModel):
@@ -20,38 +60,104 @@ class Report(BaseModel):
     error: str
 
 
+class BatchRequest(BaseModel):
+    source_ids: list[int] = Field(..., max_length=MAX_BATCH_SIZE)
+
+
 
 @app.get("/get_proxy", status_code=status.HTTP_200_OK)
 async def get_proxy(source_id: int, password: str = Depends(verify_access)):
     # request scheduler to get proxy for source
-    scheduler = Scheduler()
-    
-    return scheduler.get_proxy(source_id)[0][0]
+    # proxy is stored in redis as a json document already,
+    # so send it as is instead of encoding it once again
+    # scheduler does blocking redis and postgres calls and
+    # waits on an empty source, so it's kept off the event loop
+    proxy = (await run_in_threadpool(scheduler.get_proxy, source_id))[0][0]
+    await unblock_queue.put(orjson.loads(proxy))
+
+    return Response(content=proxy, media_type="application/json")
+
+
+@app.post("/get_proxies", status_code=status.HTTP_200_OK)
+async def get_proxies(batch: BatchRequest, password: str = Depends(verify_access)):
+    # one request for many sources, so clients don't
+    # pay for a round trip and auth per proxy,
+    # sources are popped in one threadpool call
+    # and a single redis round trip
+    proxies = await run_in_threadpool(scheduler.get_proxies, batch.source_ids)
+    for proxy in proxies:
+        await unblock_queue.put(orjson.loads(proxy))
+
+    return Response(content=b"[" + b",".join(proxies) + b"]",
+                    media_type="application/json")
 
 
 @app.post("/send_report", status_code=status.HTTP_200_OK)
 async def send_report(report: Report , password: str = Depends(verify_access)):
-    # send report to scheduler
-    report = await report
-    scheduler = Scheduler()
-    
+    # report is already validated by FastAPI
     return {"message": "Report was recieved successfully."}
 
 
-@app.middleware("http")
-async def add_custom_header(request: Request, call_next):
-    response = await call_next(request)
+async def drain_unblock_queue():
+    """ Send queued proxies to celery in batches """
+    stopping = False
+    while not stopping:
+        proxies = []
+        # wait for the first proxy, then collect everything
+        # that arrives right after it, so the whole batch
+        # goes to the broker as one message
+        timeout = None
+        while len(proxies) < UNBLOCK_BATCH_SIZE:
+            try:
+                proxy = await asyncio.wait_for(unblock_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            # None is put on the queue on shutdown
+            if proxy is None:
+                stopping = True
+                break
+            proxies.append(proxy)
+            timeout = UNBLOCK_BATCH_WAIT
+
+        if proxies:
+            await publish_unblock_batch(proxies)
+
+
+async def publish_unblock_batch(proxies):
+    """ Send a batch to celery, retrying until the broker accepts it """
+    delay = UNBLOCK_RETRY_DELAY
+    while True:
+        try:
+            # publishing is blocking broker I/O,
+            # so it mustn't hold up the event loop
+            await run_in_threadpool(unblock_proxies.apply_async, args=[proxies])
+            return
+        except Exception:
+            # the drainer must survive broker outages,
+            # otherwise nothing reads the queue anymore
+            logger.exception("Failed to send %d proxies for unblocking, retrying in %ss",
+                             len(proxies), delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, UNBLOCK_RETRY_MAX_DELAY)
+
 
-    if "/get_proxy" == request.url.path and response.status_code == 200:
-        # print the body of response
-        response_body = [chunk async for chunk in response.body_iterator][0].decode()
-        unblock_proxy.apply_async(args=[json.loads(response_body)])
-        response.body_iterator = iterate_in_threadpool(iter(response_body))
-        
-    return response
+async def stop_drainer(drainer):
+    await unblock_queue.put(None)
+    await drainer
 
 
 if __name__ == "__main__":
     # start redis sudo service redis-server start
     unblocking_proxy_subprocess.start()
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    # uvicorn[standard] is required for uvloop and httptools,
+    # see the requirements in readme.md
+    workers = int(os.getenv("WORKERS", 2))
+    # every worker has its own postgres pool, so the budget
+    # is split between them; workers inherit the environment
+    api_db_connections = int(os.getenv("API_DB_CONNECTIONS", 40))
+    os.environ.setdefault("DB_POOL_MAX", str(max(1, api_db_connections // workers)))
+    # app is passed as an import string so uvicorn
+    # can spawn a process per worker
+    uvicorn.run("main:app", host="127.0.0.1", port=8000,
+                loop="uvloop", http="httptools",
+                workers=workers)
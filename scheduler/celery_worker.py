@@ -1,6 +1,7 @@
 import os
 import json
 import time
+from collections import Counter
 
 from celery import Celery
 from dotenv import load_dotenv
@@ -14,25 +15,37 @@ celery_broker = os.getenv("CELERY_BROKER_URL")
 celery_backend = os.getenv("CELERY_RESULT_BACKEND")
 RATE_LIMIT = int(os.getenv("RATE_LIMIT"))
 celery_app = Celery('scheduler', broker=celery_broker)
+celery_app.conf.broker_pool_limit = int(os.getenv("BROKER_POOL_LIMIT", 10))
 
 
 @celery_app.task
-def unblock_proxy(proxy_dumped):
-    proxy = json.loads(proxy_dumped)
-    proxy_id = str(proxy["id"])
-    
-    with DatabaseConnector(**dbcredentials) as db:
-        scheduler = Scheduler()
-        scheduler.send_batch_to_redis(proxy["sourceid"], proxy_amount=1)
-        
-        time.sleep(RATE_LIMIT)
-        db.execute_update_query(f"UPDATE proxies SET blocked = false WHERE id = {proxy_id}")
+def unblock_proxy(proxy):
+    """ Compatibility shim for messages queued by older API
+    versions, which sent one task per proxy; the API itself
+    only sends unblock_proxies now """
+    # the oldest versions sent the proxy as a json string
+    if isinstance(proxy, str):
+        proxy = json.loads(proxy)
+    unblock_proxies([proxy])
 
-        
 
-    
+@celery_app.task
+def unblock_proxies(proxies):
+    """ Unblock a batch of proxies with a single update """
+    proxy_ids = [proxy["id"] for proxy in proxies]
+    # refill redis once per source instead of once per proxy
+    sources = Counter(proxy["sourceid"] for proxy in proxies)
+
+    scheduler = Scheduler()
+    for source_id, proxy_amount in sources.items():
+        scheduler.send_batch_to_redis(source_id, proxy_amount=proxy_amount)
+
+    time.sleep(RATE_LIMIT)
+    # connection is taken only for the update, so a task
+    # doesn't hold a pooled connection while sleeping
+    with DatabaseConnector(**dbcredentials) as db:
+        db.execute_update_query("UPDATE proxies SET blocked = false WHERE id = ANY(%s)", (proxy_ids,))
 
-    # Unblock the proxy in the database
 
 registered_tasks = celery_app.tasks.keys()
 
@@ -1,6 +1,8 @@
 import os
+import threading
 
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,6 +15,42 @@ dbcredentials = {
     "port": os.getenv("port"),
 }
 
+# connection pools shared by every DatabaseConnector
+# of the process, one pool per set of credentials
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class RetainingConnectionPool(ThreadedConnectionPool):
+    """ Pool that keeps up to maxconn idle connections """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        # minconn connections are still opened up front
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        # psycopg2 closes every returned connection above minconn,
+        # so concurrent callers would reconnect on each call;
+        # minconn is only read again in putconn, so raising it
+        # keeps the connections open without opening more now
+        self.minconn = maxconn
+
+
+def get_pool(dbname, user, password, host, port):
+    """ Get or create a connection pool for credentials """
+    key = (dbname, user, password, host, port)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = RetainingConnectionPool(
+                minconn=int(os.getenv("DB_POOL_MIN", 1)),
+                maxconn=int(os.getenv("DB_POOL_MAX", 50)),
+                dbname=dbname,
+                user=user,
+                password=password,
+                host=host,
+                port=port
+            )
+        return _pools[key]
+
+
 class DatabaseConnector:
     def __init__(self, dbname, user, password, host, port):
         self.dbname = dbname
@@ -21,36 +59,47 @@ class DatabaseConnector:
         self.host = host
         self.port = port
         self.connection = None
+        self.pool = None
 
     def connect(self):
-        self.connection = psycopg2.connect(
-            dbname=self.dbname,
-            user=self.user,
-            password=self.password,
-            host=self.host,
-            port=self.port
-        )
+        # borrow a connection instead of opening a new one
+        self.pool = get_pool(self.dbname, self.user, self.password,
+                             self.host, self.port)
+        self.connection = self.pool.getconn()
 
     def close(self):
         if self.connection:
-            self.connection.close()
+            # the pool rolls back unfinished transactions
+            # and drops connections that were closed
+            self.pool.putconn(self.connection)
+            self.connection = None
 
-    def execute_update_query(self, query):
+    def execute_update_query(self, query, params=None):
         if not self.connection:
             raise RuntimeError("Database connection is not established.")
         with self.connection.cursor() as cursor:
-            cursor.execute(query)
+            cursor.execute(query, params)
             self.connection.commit()
     
-    def execute_select_query(self, query):
+    def execute_select_query(self, query, params=None):
         if not self.connection:
             raise RuntimeError("Database connection is not established.")
         with self.connection.cursor() as cursor:
-            cursor.execute(query)
+            cursor.execute(query, params)
             rows = cursor.fetchall()
 
         return rows
 
+    def execute_returning_query(self, query, params=None):
+        if not self.connection:
+            raise RuntimeError("Database connection is not established.")
+        with self.connection.cursor() as cursor:
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            self.connection.commit()
+
+        return rows
+
     # Implementing the context manager protocol
     def __enter__(self):
         self.connect()
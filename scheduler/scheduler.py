@@ -1,23 +1,35 @@
-import json
-import time
+import os
 import logging
+import threading
 
+import orjson
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ
 import redis
 from scheduler.postgres_connector import DatabaseConnector, dbcredentials
 
+logger = logging.getLogger(__name__)
+# proxy fields stored in redis, updatedat is left out
+# because we actually don't need it
+PROXY_COLUMNS = ("id", "proxy", "sourceid", "priority", "blocked", "provider")
+
 # decorator for limiting recursion calls
 def limit_recursion(max_depth):
     def decorator(func):
         def wrapper(*args, **kwargs):
-            if wrapper.depth == max_depth:
+            depth = getattr(wrapper.local, "depth", 0)
+            if depth == max_depth:
                 raise RecursionError("Max recursion depth reached.")
-            wrapper.depth += 1
-            result = func(*args, **kwargs)
-            wrapper.depth -= 1
-            return result
-        wrapper.depth = 0
+            wrapper.local.depth = depth + 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                # restore depth even if the call failed,
+                # otherwise every error leaks one level
+                wrapper.local.depth = depth
+        # depth is tracked per thread, so concurrent
+        # calls don't count each other's recursion
+        wrapper.local = threading.local()
         return wrapper
     return decorator
 
@@ -25,21 +37,53 @@ def limit_recursion(max_depth):
 class Scheduler:
     _instance = None
     _rate_limit = 5
+    # guards lazy initialization, scheduler is used from threadpool
+    _lock = threading.Lock()
 
     def __new__(cls, *args, **kwargs):
         """ Permorming Singleton """
-        if not cls._instance:
-            cls._instance = super().__new__(cls, *args, **kwargs)
-            # Initialize async Redis connection
-            cls._instance._redis = None  # Will be initialized on first call
+        with cls._lock:
+            if not cls._instance:
+                cls._instance = super().__new__(cls, *args, **kwargs)
+                # Initialize async Redis connection
+                cls._instance._redis = None  # Will be initialized on first call
+                cls._instance._blocking_redis = None
         return cls._instance
 
+    @staticmethod
+    def _connect_redis(max_connections):
+        # bounded pool shared by every thread of the process,
+        # callers wait for a free connection instead of opening new ones
+        pool = redis.BlockingConnectionPool(
+            host='localhost', port=6379, db=0,
+            max_connections=max_connections,
+            timeout=5
+        )
+        return redis.Redis(connection_pool=pool)
+
     def _get_redis(self):
         """ Initialize Redis connection """
-        if not self._redis:
-            self._redis = redis.Redis(host='localhost', port=6379, db=0)
+        if self._redis:
+            return self._redis
+        with self._lock:
+            if not self._redis:
+                self._redis = self._connect_redis(
+                    int(os.getenv("REDIS_MAX_CONNECTIONS", 32)))
         return self._redis
 
+    def _get_blocking_redis(self):
+        """ Initialize Redis connection for blocking pops """
+        # blocking pops keep a connection for up to the rate limit,
+        # so they get their own pool and can't starve other commands;
+        # default matches the 40 threads of the API threadpool
+        if self._blocking_redis:
+            return self._blocking_redis
+        with self._lock:
+            if not self._blocking_redis:
+                self._blocking_redis = self._connect_redis(
+                    int(os.getenv("REDIS_BLOCKING_MAX_CONNECTIONS", 40)))
+        return self._blocking_redis
+
     @limit_recursion(10)
     def get_proxy(self, source_id):
         """ Get a proxy address from Redis """
@@ -50,82 +94,86 @@ class Scheduler:
         if not proxy:
             # If we operating second recursion 
             # it means that redis is empty
-            # if redis is empty we need to wait for some time
-            # for new proxies to be added to redis
-            if self.get_proxy.depth > 1:
-                time.sleep(self._rate_limit)
+            # if redis is empty we need to wait
+            # for new proxies to be added to redis,
+            # blocking pop returns as soon as one is pushed
+            if self.get_proxy.local.depth > 1:
+                popped = self._get_blocking_redis().bzpopmax(source_id, timeout=self._rate_limit)
+                if popped:
+                    _, proxy, priority = popped
+                    return [(proxy, priority)]
 
             self.send_batch_to_redis(source_id)
             return self.get_proxy(source_id)
         
         return proxy
 
+    def get_proxies(self, source_ids):
+        """ Get a proxy for each source, popping from Redis in one round trip """
+        pipe = self._get_redis().pipeline(transaction=False)
+        for source_id in source_ids:
+            pipe.zpopmax(source_id)
+        popped = pipe.execute()
+
+        try:
+            # only empty sources go through the refill path
+            for i, source_id in enumerate(source_ids):
+                if not popped[i]:
+                    popped[i] = self.get_proxy(source_id)
+        except Exception:
+            # put back what was already taken,
+            # so a failing source doesn't lose the others
+            pipe = self._get_redis().pipeline(transaction=False)
+            for source_id, proxy in zip(source_ids, popped):
+                if proxy:
+                    pipe.zadd(source_id, dict(proxy))
+            pipe.execute()
+            raise
+
+        return [proxy[0][0] for proxy in popped]
+
     def get_proxies_from_db(self, source_id, proxies_amount):
-        extract_query = f"""SELECT * FROM proxies 
-        WHERE blocked = False 
-        AND sourceId = {source_id}
-        ORDER BY priority DESC
-        LIMIT {proxies_amount}"""
-        
-        update_query = f"""UPDATE proxies
+        # select and block proxies in one statement, skipping rows
+        # that are being taken by a concurrent transaction
+        query = """UPDATE proxies
         SET blocked = True
         WHERE id in (
             SELECT id FROM proxies 
             WHERE blocked = False 
-            AND sourceId = {source_id}
+            AND sourceId = %s
             ORDER BY priority DESC
-            LIMIT {proxies_amount}
-        )"""
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING """ + ", ".join(
+            # RETURNING gives the updated row, so report blocked
+            # as it was before, like the old SELECT did
+            "false AS blocked" if column == "blocked" else column
+            for column in PROXY_COLUMNS)
 
         with DatabaseConnector(**dbcredentials) as conn:
             try:
-                # Transaction setup
-                cursor = conn.connection.cursor()
-                # Get the column names from the table
-                cursor.execute(f"SELECT column_name FROM information_schema.columns WHERE table_name = 'proxies'")
-                columns = [row[0] for row in cursor.fetchall()]
-
-                # Fetch data from the table
-                data = []
-                rows = conn.execute_select_query(extract_query)
-                for row in rows:
-                    data.append({columns[i]: value for i, value in enumerate(row)})
-                # Block the fetched proxies
-                conn.execute_update_query(update_query)
-
-                return data
+                # Block proxies and fetch their data
+                rows = conn.execute_returning_query(query, (source_id, proxies_amount))
+
+                return [dict(zip(PROXY_COLUMNS, row)) for row in rows]
             
             except psycopg2.Error as e:
-                logging.error("Error while fetching proxies from the database: {1}".format(e))
+                logger.error("Error while fetching proxies from the database: %s", e)
                 conn.connection.rollback()
                 return []
     
     def send_batch_to_redis(self, source_id, proxy_amount=100):
         # grab batch of proxies from db
         # store in redis
-        redis = self._get_redis()
-
         db_proxies = self.get_proxies_from_db(source_id, proxy_amount)
-        for proxy in db_proxies:
-            self.push_proxy_to_redis(source_id, proxy)
-
-        redis.expire(source_id, 360)
-
 
-    def push_proxy_to_redis(self, source_id, proxy_data):
-        """ Function for adding fresh proxy to Redis """
-        # Get connection to Redis
-        redis = self._get_redis()
-        
-        # Store the proxy address in Redis
-        priority = proxy_data['priority']
-        
-        # need to remove updatedAt field 
-        # because it is not serializable
-        # and we actually don't need it
-        del proxy_data["updatedat"]
-        # Dump json to string
-        # and add to Redis
-        dumped_data = json.dumps(proxy_data)
-        redis.zadd(source_id, {dumped_data: priority})
+        # send the whole batch in a single round trip,
+        # no MULTI/EXEC needed for independent writes
+        pipe = self._get_redis().pipeline(transaction=False)
+        if db_proxies:
+            # one variadic ZADD instead of a command per proxy
+            pipe.zadd(source_id, {orjson.dumps(proxy): proxy['priority'] for proxy in db_proxies})
 
+        pipe.expire(source_id, 360)
+        pipe.execute()